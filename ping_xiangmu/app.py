@@ -1,17 +1,42 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, url_for
+from flask.json.provider import DefaultJSONProvider
 from datetime import datetime, timedelta
 import json
+import orjson
+import numpy as np
 from pathlib import Path
 import threading
+import time
 from modules.task_manager import TaskManager
 from modules.data_manager import DataManager
+from modules.ping_monitor import STATUS_SUCCESS, STATUS_LABELS
+from utils.helpers import rolling_availability
 from config import create_directories, Config, PATHS
 import os
 
 # 创建必要的目录
 create_directories()
 
+def _fallback(obj):
+    """orjson无法直接序列化的类型（如pandas.Timestamp）"""
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class OrjsonProvider(DefaultJSONProvider):
+    """使用orjson的JSON序列化"""
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SERIALIZE_DATACLASS
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option, default=_fallback).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config.from_object(Config)
 
 # 初始化管理器
@@ -63,10 +88,16 @@ def task_details(task_id):
     # 获取报告
     report = data_manager.get_task_report(task_id)
     
+    data_preview = []
+    if data is not None:
+        preview = data.head(100)
+        preview = preview.assign(status=preview['status'].map(dict(enumerate(STATUS_LABELS))))
+        data_preview = preview.to_dict('records')
+    
     return render_template(
         'results.html',
         task=task_info,
-        data_preview=data.head(100).to_dict('records') if data is not None else [],
+        data_preview=data_preview,
         report=report
     )
 
@@ -76,23 +107,71 @@ def task_status(task_id):
     task_info = task_manager.get_task_status(task_id)
     return jsonify(task_info)
 
+@app.route('/api/task/<task_id>/stream')
+def task_stream(task_id):
+    """任务状态推送（Server-Sent Events）"""
+    def generate():
+        while True:
+            task_info = task_manager.get_task_status(task_id)
+            yield f"data: {app.json.dumps(task_info)}\n\n"
+            
+            if task_info.get('status') != 'running':
+                break
+                
+            # 任务结束时立即唤醒，否则每2秒推送一次进度
+            task_manager.wait_for_task(task_id, timeout=2)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/api/task/<task_id>/data')
 def task_data(task_id):
-    """获取任务数据API"""
-    data = data_manager.load_task_data(task_id)
+    """获取任务数据API
+
+    默认返回最近1000个数据点；range=full返回整个任务的数据，
+    超过MAX_DATA_POINTS时均匀抽样（供完整报告图表使用）
+    """
+    found = data_manager.stat_data_file(task_id)
+    
+    if found is None:
+        return jsonify({'error': '数据不存在'}), 404
+    
+    # 文件未变化时直接返回304（If-None-Match按弱比较，支持多个ETag）
+    st = found[1]
+    etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    if request.if_none_match.contains_weak(etag):
+        return _with_cache_headers(app.response_class(status=304), etag)
+    
+    columns = ['timestamp', 'response_time', 'status']
+    if request.args.get('range') == 'full':
+        data = data_manager.load_task_data(task_id, columns=columns)
+    else:
+        # 只返回最近的数据点（限制数量）
+        data = data_manager.load_recent_data(task_id, limit=1000, columns=columns)
     
     if data is None:
         return jsonify({'error': '数据不存在'}), 404
-        
-    # 只返回最近的数据点（限制数量）
-    limit = min(1000, len(data))
-    recent_data = data.tail(limit)
     
-    return jsonify({
-        'timestamps': recent_data['timestamp'].tolist(),
-        'response_times': recent_data['response_time'].tolist(),
-        'statuses': recent_data['status'].tolist()
+    statuses = data['status'].to_numpy()
+    availability = rolling_availability(statuses, STATUS_SUCCESS)
+    
+    # 均匀抽样（滚动可用率已按全部数据计算）
+    step = max(1, -(-len(data) // app.config['MAX_DATA_POINTS']))
+    rows = np.arange(0, len(data), step)
+    
+    # numpy数组由orjson直接序列化
+    response = jsonify({
+        'timestamps': data['timestamp'].to_numpy()[rows],
+        'response_times': data['response_time'].to_numpy()[rows],
+        'statuses': statuses[rows],
+        'availability': availability[rows]
     })
+    return _with_cache_headers(response, etag)
+
+def _with_cache_headers(response, etag):
+    """设置数据API的缓存头（200和304响应相同）"""
+    response.set_etag(etag)
+    response.cache_control.max_age = 1
+    return response
 
 @app.route('/stop_task/<task_id>', methods=['POST'])
 def stop_task(task_id):
@@ -116,13 +195,29 @@ def export_data(task_id):
     except Exception as e:
         return str(e), 404
 
+@app.route('/export/<task_id>.parquet')
+def export_parquet(task_id):
+    """下载原始Parquet数据"""
+    try:
+        source = data_manager.export_to_parquet(task_id)
+    except Exception:
+        return "数据不存在", 404
+        
+    return send_file(
+        source,
+        as_attachment=True,
+        download_name=f"ping_data_{task_id}.parquet",
+        mimetype='application/vnd.apache.parquet'
+    )
+
 @app.route('/chart/<task_id>')
 def get_chart(task_id):
-    """获取图表"""
-    chart_path = Path(f"data/processed/chart_{task_id}.png")
+    """获取图表描述（Vega-Lite，由浏览器渲染）"""
+    chart_path = Path(f"data/processed/chart_{task_id}.json")
     
     if chart_path.exists():
-        return send_file(chart_path, mimetype='image/png')
+        # send_file根据修改时间生成ETag，If-None-Match命中时返回304
+        return send_file(chart_path, mimetype='application/json', max_age=1)
     else:
         return "图表不存在", 404
 
@@ -132,6 +227,11 @@ def list_tasks():
     tasks = task_manager.get_all_tasks()
     return jsonify(tasks)
 
+@app.route('/admin/rebuild-index')
+def rebuild_index():
+    """扫描磁盘数据文件重建任务索引（按需调用，较慢）"""
+    return jsonify(data_manager.get_all_tasks())
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup():
     """清理旧数据"""
@@ -147,23 +247,24 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'active_tasks': len(task_manager.active_tasks),
+        'task_counts': task_manager.get_task_counts(),
         'timestamp': datetime.now().isoformat()
     })
 
-# 启动时清理旧数据
-@app.before_first_request
+# 启动时在后台清理旧数据，不阻塞请求
 def startup_tasks():
     """应用启动时的初始化任务"""
-    data_manager.clean_old_data(days_to_keep=30)
-    
-    # 启动定期清理任务
     def periodic_cleanup():
         while True:
-            time.sleep(3600)  # 每小时检查一次
             data_manager.clean_old_data(days_to_keep=30)
+            time.sleep(3600)  # 每小时检查一次
     
     cleanup_thread = threading.Thread(target=periodic_cleanup, daemon=True)
     cleanup_thread.start()
 
+# 报告进程池的子进程会以__mp_main__重新导入主模块，不在其中启动清理线程
+if __name__ != '__mp_main__':
+    startup_tasks()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,10 +1,42 @@
+import io
 import json
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
 from pathlib import Path
 from datetime import datetime, timedelta
 import shutil
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
+from utils.helpers import write_json
+from .ping_monitor import (
+    STATUS_SUCCESS, STATUS_TIMEOUT, STATUS_LABELS, COLUMNS,
+    WRITE_OPTIONS, table_to_dataframe, data_parts, read_data_table
+)
+
+# 数据文件元数据缓存，键为路径，值为 (修改时间, 元数据)
+# 每个路径只保留一项，修改时间变化（运行中任务每分钟写入分片）时替换
+_file_info_cache: Dict[str, Tuple[int, dict]] = {}
+
+def _read_file_info(path: Path, mtime_ns: int) -> dict:
+    """从Parquet文件尾元数据获取行数、目标地址、开始时间和文件大小（文件或分片目录）"""
+    cached = _file_info_cache.get(str(path))
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+        
+    parts = data_parts(path)
+    metadata = [pq.read_metadata(part) for part in parts]
+    info = {
+        'num_rows': sum(m.num_rows for m in metadata),
+        'target': metadata[0].metadata[b'target'].decode(),
+        'start': datetime.fromisoformat(metadata[0].metadata[b'start'].decode()),
+        'size': sum(part.stat().st_size for part in parts)
+    }
+    _file_info_cache[str(path)] = (mtime_ns, info)
+    return info
 
 class DataManager:
     def __init__(self, base_path="data"):
@@ -19,33 +51,93 @@ class DataManager:
         filename = f"ping_{task_id}_{timestamp}.json"
         
         filepath = self.raw_path / filename
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
+        write_json(filepath, data)
             
         return filepath
     
-    def load_task_data(self, task_id: str) -> Optional[pd.DataFrame]:
+    def find_data_file(self, task_id: str) -> Optional[Path]:
+        """获取任务数据路径：已结束任务的数据文件，或运行中（中断）任务的分片目录"""
+        data_file = self.raw_path / f"ping_{task_id}.parquet"
+        if data_file.exists():
+            return data_file
+            
+        data_dir = self.raw_path / f"ping_{task_id}"
+        return data_dir if data_dir.is_dir() else None
+    
+    def stat_data_file(self, task_id: str) -> Optional[Tuple[Path, os.stat_result]]:
+        """获取任务数据路径及其状态
+
+        分片目录可能在查找之后被合并删除，此时重新查找（得到合并后的文件）
+        """
+        for _ in range(2):
+            data_file = self.find_data_file(task_id)
+            if data_file is None:
+                return None
+            try:
+                return data_file, data_file.stat()
+            except FileNotFoundError:
+                continue
+        return None
+    
+    def load_task_data(self, task_id: str, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
         """加载任务数据"""
-        pattern = f"ping_{task_id}_*.csv"
-        files = list(self.raw_path.glob(pattern))
+        found = self.stat_data_file(task_id)
         
-        if not files:
+        if found is None:
             return None
             
-        # 合并所有数据文件
-        dfs = []
-        for file in sorted(files):
-            try:
-                df = pd.read_csv(file)
-                dfs.append(df)
-            except Exception as e:
-                print(f"Error reading {file}: {e}")
-                
-        if not dfs:
+        # 文件（目录）修改时间作为缓存键的一部分，写入新数据后缓存自然失效
+        data_file, st = found
+        return self._load_task_data_impl(
+            data_file, st.st_mtime_ns, tuple(columns) if columns else None
+        )
+    
+    @lru_cache(maxsize=32)
+    def _load_task_data_impl(self, data_file: Path, mtime_ns: int,
+                             columns: Optional[tuple]) -> Optional[pd.DataFrame]:
+        """读取任务数据文件（结果按文件和修改时间缓存，调用方不应修改返回值）"""
+        try:
+            table = read_data_table(data_file, columns=[COLUMNS[c] for c in columns] if columns else None)
+        except Exception as e:
+            # 读取过程中分片目录已被合并为单个文件
+            print(f"Error reading {data_file}: {e}")
+            return None
+            
+        return table_to_dataframe(table) if table is not None else None
+    
+    def load_recent_data(self, task_id: str, limit: int = 1000,
+                         columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """通过内存映射只读取最后若干行组，返回最近limit行"""
+        data_file = self.find_data_file(task_id)
+        
+        if data_file is None:
+            return None
+            
+        fields = [COLUMNS[c] for c in columns] if columns else None
+        tables = []
+        rows = 0
+        try:
+            # 从最后一个分片的最后一个行组向前读取，直到凑够limit行
+            for part in reversed(data_parts(data_file)):
+                with pa.memory_map(str(part), 'r') as source:
+                    pf = pq.ParquetFile(source)
+                    for i in range(pf.num_row_groups - 1, -1, -1):
+                        table = pf.read_row_group(i, columns=fields)
+                        tables.append(table)
+                        rows += table.num_rows
+                        if rows >= limit:
+                            break
+                if rows >= limit:
+                    break
+        except Exception as e:
+            print(f"Error reading {data_file}: {e}")
+            return None
+            
+        if not tables:
             return None
             
-        combined_df = pd.concat(dfs, ignore_index=True)
-        return combined_df
+        table = pa.concat_tables(reversed(tables))
+        return table_to_dataframe(table.slice(max(0, table.num_rows - limit)))
     
     def get_task_report(self, task_id: str) -> Optional[dict]:
         """获取任务报告"""
@@ -60,32 +152,37 @@ class DataManager:
     def get_all_tasks(self) -> List[dict]:
         """获取所有任务列表"""
         tasks = []
+        seen = set()
         
-        # 从原始数据文件获取任务信息
-        raw_files = list(self.raw_path.glob("ping_*.csv"))
-        
-        for file in raw_files:
-            parts = file.stem.split('_')
-            if len(parts) >= 3:
-                ip = parts[1]
-                task_time = parts[2]
-                
-                try:
-                    task_date = datetime.strptime(task_time[:8], '%Y%m%d')
-                    
-                    # 读取部分数据获取统计信息
-                    df = pd.read_csv(file, nrows=100)
-                    
-                    task_info = {
-                        'ip': ip,
-                        'task_time': task_time,
-                        'date': task_date.strftime('%Y-%m-%d'),
-                        'data_points': len(pd.read_csv(file)) if file.stat().st_size > 0 else 0,
-                        'file_size': file.stat().st_size
-                    }
-                    tasks.append(task_info)
-                except:
+        # 从原始数据文件（已结束）和分片目录（运行中或中断）获取任务信息
+        for path in self.raw_path.glob("ping_*"):
+            if path.is_dir():
+                # 合并完成、目录尚未删除时以合并后的文件为准
+                if path.with_suffix('.parquet').exists():
                     continue
+            elif path.suffix != '.parquet':
+                continue
+                
+            seen.add(str(path))
+            try:
+                file_info = _read_file_info(path, path.stat().st_mtime_ns)
+            except Exception:
+                # 还没有写入任何分片，或读取时目录已被合并
+                continue
+                
+            task_info = {
+                'task_id': path.stem[len('ping_'):],
+                'ip': file_info['target'],
+                'task_time': file_info['start'].strftime('%Y%m%d_%H%M%S'),
+                'date': file_info['start'].strftime('%Y-%m-%d'),
+                'data_points': file_info['num_rows'],
+                'file_size': file_info['size']
+            }
+            tasks.append(task_info)
+            
+        # 移除已合并或已清理的路径，缓存大小不超过现有数据文件数
+        for key in _file_info_cache.keys() - seen:
+            _file_info_cache.pop(key, None)
                     
         return sorted(tasks, key=lambda x: x['task_time'], reverse=True)
     
@@ -94,17 +191,22 @@ class DataManager:
         cutoff_date = datetime.now() - timedelta(days=days_to_keep)
         
         # 清理原始数据
-        for file in self.raw_path.glob("*.csv"):
+        for file in self.raw_path.glob("*.parquet"):
             if file.stat().st_mtime < cutoff_date.timestamp():
                 file.unlink()
                 
+        # 清理中断任务遗留的分片目录
+        for data_dir in self.raw_path.glob("ping_*"):
+            if data_dir.is_dir() and data_dir.stat().st_mtime < cutoff_date.timestamp():
+                shutil.rmtree(data_dir, ignore_errors=True)
+                
         # 清理报告
         for file in self.reports_path.glob("*.json"):
             if file.stat().st_mtime < cutoff_date.timestamp():
                 file.unlink()
                 
         # 清理图表
-        for file in self.processed_path.glob("*.png"):
+        for file in self.processed_path.glob("chart_*.json"):
             if file.stat().st_mtime < cutoff_date.timestamp():
                 file.unlink()
     
@@ -116,24 +218,64 @@ class DataManager:
             
         export_path = self.processed_path / f"export_{task_id}.xlsx"
         
-        with pd.ExcelWriter(export_path, engine='openpyxl') as writer:
+        # constant_memory模式逐行写入并立即释放，内存占用与行数无关
+        workbook = xlsxwriter.Workbook(str(export_path), {
+            'constant_memory': True,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss'
+        })
+        
+        with workbook:
             # 写入原始数据
-            df.to_excel(writer, sheet_name='Raw Data', index=False)
+            raw_df = df.assign(status=df['status'].map(dict(enumerate(STATUS_LABELS))))
+            self._write_sheet(workbook, 'Raw Data', raw_df)
+            
+            # 写入统计信息（int8状态列上的向量化计数，只计算一次）
+            status = df['status'].values
+            total = len(df)
+            successful = int(np.count_nonzero(status == STATUS_SUCCESS))
+            timeout = int(np.count_nonzero(status == STATUS_TIMEOUT))
             
-            # 写入统计信息
             stats_df = pd.DataFrame([{
                 'Metric': 'Total Pings',
-                'Value': len(df)
+                'Value': total
             }, {
                 'Metric': 'Successful Pings',
-                'Value': len(df[df['status'] == 'success'])
+                'Value': successful
             }, {
                 'Metric': 'Timeout Pings',
-                'Value': len(df[df['status'] == 'timeout'])
+                'Value': timeout
+            }, {
+                'Metric': 'Error Pings',
+                'Value': total - successful - timeout
             }, {
                 'Metric': 'Availability',
-                'Value': f"{len(df[df['status'] == 'success']) / len(df) * 100:.2f}%"
+                'Value': f"{successful / total * 100:.2f}%" if total else "N/A"
             }])
-            stats_df.to_excel(writer, sheet_name='Statistics', index=False)
+            self._write_sheet(workbook, 'Statistics', stats_df)
+            
+        return export_path
+    
+    def export_to_parquet(self, task_id: str) -> Union[Path, io.BytesIO]:
+        """导出Parquet数据：已结束任务直接返回数据文件，否则合并已写入的分片"""
+        data_file = self.find_data_file(task_id)
+        if data_file is not None and not data_file.is_dir():
+            return data_file
             
-        return export_path
\ No newline at end of file
+        table = read_data_table(data_file) if data_file is not None else None
+        if table is None:
+            raise ValueError(f"No data found for task {task_id}")
+            
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, **WRITE_OPTIONS)
+        buffer.seek(0)
+        return buffer
+    
+    @staticmethod
+    def _write_sheet(workbook, sheet_name: str, df: pd.DataFrame):
+        """按行写入工作表（constant_memory模式要求行顺序写入）"""
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, df.columns)
+        
+        for row, values in enumerate(df.itertuples(index=False, name=None), start=1):
+            # 缺失值（NaN/NaT）写为空单元格
+            worksheet.write_row(row, 0, [None if v != v else v for v in values])
\ No newline at end of file
@@ -1,172 +1,398 @@
-import time
+import asyncio
+import multiprocessing
+import os
+import shutil
 import threading
 import json
+from concurrent.futures import Future, ProcessPoolExecutor, wait
 from datetime import datetime, timedelta
-from ping3 import ping
+from icmplib import async_ping
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')  # 使用非交互式后端
+from utils.helpers import write_json
+
+# 状态编码（int8）
+STATUS_SUCCESS = 0
+STATUS_TIMEOUT = 1
+STATUS_ERROR = 2
+STATUS_LABELS = ('success', 'timeout', 'error')
+
+# Parquet数据文件结构：发送时刻相对开始时间的毫秒数、响应时间、状态编码、错误信息
+# 目标地址、开始时间和偏移单位每个文件只有一份，存放在文件元数据中
+# （int32毫秒可覆盖约24.8天；旧文件没有单位元数据，偏移为秒）
+PING_SCHEMA = pa.schema([
+    ('t_off', pa.int32()),
+    ('rt', pa.float32()),
+    ('st', pa.int8()),
+    ('err', pa.string())
+])
+
+# DataFrame列名 -> 文件列名
+COLUMNS = {'timestamp': 't_off', 'response_time': 'rt', 'status': 'st', 'error': 'err'}
+
+# Parquet写入参数（分片文件与合并后的文件相同）
+WRITE_OPTIONS = {
+    'compression': 'zstd',
+    'use_dictionary': ['st', 'err'],
+    'data_page_size': 1 << 16
+}
+
+def data_parts(path):
+    """数据路径包含的Parquet文件
+
+    运行中（或进程中断）的任务是分片目录，每分钟一个已关闭的分片文件；
+    任务结束后合并为单个文件
+    """
+    path = Path(path)
+    if path.is_dir():
+        return sorted(path.glob('part-*.parquet'))
+    return [path]
+
+def read_data_table(path, columns=None):
+    """读取数据文件或分片目录，没有数据时返回None"""
+    tables = [pq.read_table(part, columns=columns) for part in data_parts(path)]
+    return pa.concat_tables(tables) if tables else None
+
+def table_to_dataframe(table):
+    """将数据文件表转换为DataFrame（由开始时间和偏移还原时间戳）"""
+    data = {}
+    for name, field in COLUMNS.items():
+        if field not in table.column_names:
+            continue
+        values = table.column(field).to_numpy()
+        if name == 'timestamp':
+            metadata = table.schema.metadata
+            start = np.datetime64(metadata[b'start'].decode(), 'ms')
+            unit = metadata.get(b't_unit', b's').decode()
+            values = start + values.astype(f'timedelta64[{unit}]')
+        data[name] = values
+    return pd.DataFrame(data)
+
+# 所有任务共享的ping事件循环（I/O密集）
+_loop = None
+_loop_lock = threading.Lock()
+
+# 运行中的监控器，由调度协程每秒统一ping一次
+_monitors = []
+_scheduler = None
+_background_tasks = set()
+
+# root下使用原始套接字，否则使用无特权ICMP套接字
+_PRIVILEGED = hasattr(os, 'geteuid') and os.geteuid() == 0
+
+# 报告生成进程池（CPU密集的统计），首次生成报告时创建
+_report_pool = None
+
+def _get_loop():
+    """获取（必要时启动）后台事件循环线程"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+def _get_report_pool():
+    """获取（必要时创建）报告进程池
+
+    不使用fork启动子进程：fork会复制Flask线程、事件循环线程和锁的状态
+    """
+    global _report_pool
+    with _loop_lock:
+        if _report_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _report_pool = ProcessPoolExecutor(
+                max_workers=2,
+                mp_context=multiprocessing.get_context(method)
+            )
+    return _report_pool
+
+def _add_monitor(monitor):
+    """注册监控器（在事件循环线程中执行）"""
+    global _scheduler
+    _monitors.append(monitor)
+    if _scheduler is None or _scheduler.done():
+        _scheduler = _loop.create_task(_schedule_pings())
+
+def _spawn(coro):
+    """在事件循环中启动后台任务（保留引用直到完成）"""
+    task = _loop.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _ping_once(monitor, sent_time):
+    """ping一次目标并记录结果，单个任务出错不影响其他任务"""
+    try:
+        result = await async_ping(monitor.target_ip, count=1, timeout=2, privileged=_PRIVILEGED)
+    except Exception as e:
+        result = e
+    try:
+        monitor._record(result, sent_time)
+    except Exception as e:
+        print(f"Error recording ping for task {monitor.task_id}: {e}")
+
+async def _schedule_pings():
+    """按固定节拍每秒为所有运行中的目标发起一次ping
+
+    每个目标的ping作为独立任务执行，完成时自行记录结果，
+    慢速或不可达的目标不会拖慢其他任务的采样
+    """
+    next_tick = _loop.time()
+    while _monitors:
+        now = datetime.now()  # 本拍的发送时刻，作为各目标记录的时间戳
+        
+        # 结束已停止或到期的任务
+        for monitor in [m for m in _monitors if not m.is_running or now >= m.end_time]:
+            _monitors.remove(monitor)
+            _spawn(monitor._finish())
+            
+        # 上一次ping尚未返回的目标本轮跳过，保证记录按时间顺序
+        for monitor in _monitors:
+            if monitor.pending is None or monitor.pending.done():
+                monitor.pending = _spawn(_ping_once(monitor, now))
+                
+        # 以循环时钟为基准计算下一拍，不累积ping耗时；落后过多时不补拍
+        next_tick = max(next_tick + 1, _loop.time())
+        await asyncio.sleep(next_tick - _loop.time())
 
 class PingMonitor:
-    def __init__(self, target_ip, duration_hours, task_id):
+    def __init__(self, target_ip, duration_hours, task_id, on_finish=None):
         self.target_ip = target_ip
         self.duration = timedelta(hours=duration_hours)
         self.task_id = task_id
+        self.on_finish = on_finish  # 到期结束后的回调，参数为task_id
         self.is_running = False
         self.start_time = None
+        self.end_time = None
+        self.data_dir = None
         self.data_file = None
-        self.thread = None
+        self.schema = None
+        self.future = None
+        self.pending = None  # 尚未返回的ping任务
         
     def start(self):
         """开始ping监控"""
         self.is_running = True
         self.start_time = datetime.now()
-        self.thread = threading.Thread(target=self._ping_loop)
-        self.thread.daemon = True
-        self.thread.start()
+        self.end_time = self.start_time + self.duration
+        
+        # 按任务时长预分配列式缓冲区（每秒一行）
+        self.n = int(self.duration.total_seconds()) + 1
+        self.t_off = np.empty(self.n, 'int32')
+        self.rt = np.empty(self.n, 'float32')
+        self.st = np.empty(self.n, 'int8')
+        self.err = np.full(self.n, None, object)
+        self.i = 0
+        self.flushed = 0
+        self.part = 0
+        
+        # 创建分片目录（按任务ID命名，便于直接定位），结束后合并为单个文件
+        self.data_dir = Path(f"data/raw/ping_{self.task_id}")
+        self.data_file = self.data_dir.with_suffix('.parquet')
+        self.data_dir.mkdir(exist_ok=True)
+        self.schema = PING_SCHEMA.with_metadata({
+            'target': self.target_ip,
+            'start': self.start_time.isoformat(),
+            't_unit': 'ms'
+        })
+        
+        self.future = Future()
+        _get_loop().call_soon_threadsafe(_add_monitor, self)
         
     def stop(self):
         """停止ping监控"""
         self.is_running = False
-        if self.thread:
-            self.thread.join(timeout=5)
+        if self.future:
+            wait([self.future], timeout=5)
             
-    def _ping_loop(self):
-        """执行ping循环"""
-        data_points = []
-        end_time = self.start_time + self.duration
-        
-        # 创建数据文件
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        self.data_file = Path(f"data/raw/ping_{self.target_ip}_{timestamp}.csv")
-        
-        while self.is_running and datetime.now() < end_time:
-            try:
-                # 执行ping
-                response_time = ping(self.target_ip, timeout=2, unit='ms')
-                
-                # 记录数据点
-                data_point = {
-                    'timestamp': datetime.now().isoformat(),
-                    'target': self.target_ip,
-                    'response_time': response_time if response_time else None,
-                    'status': 'success' if response_time else 'timeout'
-                }
-                
-                data_points.append(data_point)
-                
-                # 每10个数据点保存一次
-                if len(data_points) >= 10:
-                    self._save_data(data_points)
-                    data_points = []
-                    
-            except Exception as e:
-                error_point = {
-                    'timestamp': datetime.now().isoformat(),
-                    'target': self.target_ip,
-                    'response_time': None,
-                    'status': 'error',
-                    'error': str(e)
-                }
-                data_points.append(error_point)
-                
-            time.sleep(1)  # 每秒ping一次
+    def _record(self, result, sent_time):
+        """记录一次ping结果（时间戳取发送时刻，与响应时间和超时无关）"""
+        if self.i >= self.n:
+            return
             
-        # 保存剩余数据
-        if data_points:
-            self._save_data(data_points)
+        error = None
+        if isinstance(result, Exception):
+            response_time = np.nan
+            status = STATUS_ERROR
+            error = str(result) or type(result).__name__
+        elif result.is_alive:
+            response_time = result.avg_rtt
+            status = STATUS_SUCCESS
+        else:
+            response_time = np.nan
+            status = STATUS_TIMEOUT
             
-        # 生成报告
-        self._generate_report()
-        
-    def _save_data(self, data_points):
-        """保存数据到CSV"""
-        df = pd.DataFrame(data_points)
-        file_exists = self.data_file.exists()
+        i = self.i
+        self.t_off[i] = (sent_time - self.start_time) // timedelta(milliseconds=1)
+        self.rt[i] = response_time
+        self.st[i] = status
+        self.err[i] = error
+        self.i = i + 1
         
-        # 追加或新建文件
-        df.to_csv(
-            self.data_file, 
-            mode='a', 
-            header=not file_exists, 
-            index=False
-        )
-        
-    def _generate_report(self):
-        """生成分析报告和图表"""
-        if not self.data_file or not self.data_file.exists():
-            return
+        # 每60个数据点（约1分钟）保存一次，每次写入一个分片文件
+        if self.i - self.flushed >= 60:
+            self._save_data()
             
-        # 读取数据
-        df = pd.read_csv(self.data_file)
-        
-        # 转换为时间格式
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        
-        # 统计信息
-        stats = {
-            'total_pings': len(df),
-            'successful_pings': len(df[df['status'] == 'success']),
-            'timeout_pings': len(df[df['status'] == 'timeout']),
-            'error_pings': len(df[df['status'] == 'error']),
-            'avg_response_time': df['response_time'].mean(),
-            'min_response_time': df['response_time'].min(),
-            'max_response_time': df['response_time'].max(),
-            'availability': len(df[df['status'] == 'success']) / len(df) * 100
-        }
-        
-        # 生成图表
-        self._create_charts(df, stats)
+    async def _finish(self):
+        """保存剩余数据并生成报告"""
+        try:
+            # 等待最后一次ping记录完成，再关闭文件
+            if self.pending is not None:
+                await asyncio.wait([self.pending])
+                
+            if self.i > self.flushed:
+                self._save_data()
+                
+            # 在进程池中合并分片并生成报告，不阻塞其他任务的ping
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                _get_report_pool(), _finalize_task, self.data_dir, self.data_file, self.task_id
+            )
+        except Exception as e:
+            print(f"Error finishing task {self.task_id}: {e}")
+        finally:
+            if self.on_finish:
+                self.on_finish(self.task_id)
+            self.future.set_result(None)
         
-        # 保存统计信息
-        report_file = Path(f"data/reports/report_{self.task_id}.json")
-        with open(report_file, 'w') as f:
-            json.dump(stats, f, indent=2, default=str)
-            
-    def _create_charts(self, df, stats):
-        """创建图表"""
-        fig, axes = plt.subplots(2, 2, figsize=(15, 10))
+    def _save_data(self):
+        """将缓冲区中未保存的数据写为一个完整的分片文件
+
+        分片写完后才重命名为正式文件名，读取方只会看到带文件尾的完整分片，
+        进程中断时最多丢失最近一分钟的数据
+        """
+        rows = slice(self.flushed, self.i)
         
-        # 响应时间趋势图
-        success_df = df[df['status'] == 'success'].copy()
-        if not success_df.empty:
-            axes[0, 0].plot(success_df['timestamp'], success_df['response_time'])
-            axes[0, 0].set_title('Response Time Trend')
-            axes[0, 0].set_xlabel('Time')
-            axes[0, 0].set_ylabel('Response Time (ms)')
-            axes[0, 0].grid(True, alpha=0.3)
-            
-        # 状态分布饼图
-        status_counts = df['status'].value_counts()
-        axes[0, 1].pie(
-            status_counts.values, 
-            labels=status_counts.index,
-            autopct='%1.1f%%',
-            startangle=90
-        )
-        axes[0, 1].set_title('Ping Status Distribution')
+        table = pa.Table.from_arrays([
+            pa.array(self.t_off[rows]),
+            pa.array(self.rt[rows], from_pandas=True),
+            pa.array(self.st[rows]),
+            pa.array(self.err[rows], type=pa.string())
+        ], schema=self.schema)
         
-        # 响应时间分布直方图
-        if not success_df.empty:
-            axes[1, 0].hist(success_df['response_time'].dropna(), bins=50, alpha=0.7)
-            axes[1, 0].set_title('Response Time Distribution')
-            axes[1, 0].set_xlabel('Response Time (ms)')
-            axes[1, 0].set_ylabel('Frequency')
-            
-        # 可用性趋势图
-        df['success'] = df['status'] == 'success'
-        df['rolling_availability'] = df['success'].rolling(window=60).mean() * 100
-        axes[1, 1].plot(df['timestamp'], df['rolling_availability'])
-        axes[1, 1].set_title('Availability Trend (5-min rolling)')
-        axes[1, 1].set_xlabel('Time')
-        axes[1, 1].set_ylabel('Availability (%)')
-        axes[1, 1].grid(True, alpha=0.3)
+        part_file = self.data_dir / f"part-{self.part:05d}.parquet"
+        tmp_file = part_file.with_suffix('.tmp')
+        pq.write_table(table, tmp_file, **WRITE_OPTIONS)
+        os.replace(tmp_file, part_file)
         
-        plt.tight_layout()
+        self.part += 1
+        self.flushed = self.i
+
+def _finalize_task(data_dir, data_file, task_id):
+    """合并分片文件并生成报告（在报告进程池中执行）"""
+    parts = data_parts(data_dir)
+    if parts:
+        # 每个分片写为一个行组，合并后仍是每分钟一个行组
+        tmp_file = data_file.with_suffix('.tmp')
+        with pq.ParquetWriter(tmp_file, pq.read_schema(parts[0]), **WRITE_OPTIONS) as writer:
+            for part in parts:
+                writer.write_table(pq.read_table(part))
+        os.replace(tmp_file, data_file)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    
+    _generate_report(data_file, task_id)
+
+def _generate_report(data_file, task_id):
+    """生成分析报告和图表描述（在报告进程池中执行）"""
+    if not data_file or not data_file.exists():
+        return
         
-        # 保存图表
-        chart_file = Path(f"data/processed/chart_{self.task_id}.png")
-        plt.savefig(chart_file, dpi=150, bbox_inches='tight')
-        plt.close()
\ No newline at end of file
+    # 读取数据
+    df = table_to_dataframe(pq.read_table(data_file))
+    
+    # 统计信息：一次计数 + 一次聚合
+    counts = df['status'].value_counts().reindex(
+        [STATUS_SUCCESS, STATUS_TIMEOUT, STATUS_ERROR], fill_value=0
+    )
+    rt = df.loc[df['status'].values == STATUS_SUCCESS, 'response_time'].agg(['mean', 'min', 'max'])
+    
+    stats = {
+        'total_pings': len(df),
+        'successful_pings': int(counts[STATUS_SUCCESS]),
+        'timeout_pings': int(counts[STATUS_TIMEOUT]),
+        'error_pings': int(counts[STATUS_ERROR]),
+        'avg_response_time': rt['mean'],
+        'min_response_time': rt['min'],
+        'max_response_time': rt['max'],
+        'availability': counts[STATUS_SUCCESS] / len(df) * 100 if len(df) else 0
+    }
+    
+    # 生成图表描述
+    _write_chart_spec(task_id)
+    
+    # 保存统计信息
+    report_file = Path(f"data/reports/report_{task_id}.json")
+    write_json(report_file, stats)
+
+def _write_chart_spec(task_id):
+    """写入Vega-Lite图表描述，由浏览器从数据API取数并渲染（覆盖整个任务时段）"""
+    success = f"datum.status_code == {STATUS_SUCCESS}"
+    
+    spec = {
+        '$schema': 'https://vega.github.io/schema/vega-lite/v5.json',
+        'data': {'url': f'/api/task/{task_id}/data?range=full'},
+        'transform': [
+            # 数据API返回按列的数组，展开为逐行数据
+            {
+                'flatten': ['timestamps', 'response_times', 'statuses', 'availability'],
+                'as': ['timestamp', 'response_time', 'status_code', 'rolling_availability']
+            },
+            {'calculate': f"{json.dumps(list(STATUS_LABELS))}[datum.status_code]", 'as': 'status'}
+        ],
+        'columns': 2,
+        'concat': [
+            # 响应时间趋势图
+            {
+                'title': 'Response Time Trend',
+                'width': 400,
+                'height': 250,
+                'transform': [{'filter': success}],
+                'mark': 'line',
+                'encoding': {
+                    'x': {'field': 'timestamp', 'type': 'temporal', 'title': 'Time'},
+                    'y': {'field': 'response_time', 'type': 'quantitative', 'title': 'Response Time (ms)'}
+                }
+            },
+            # 状态分布饼图
+            {
+                'title': 'Ping Status Distribution',
+                'width': 250,
+                'height': 250,
+                'mark': 'arc',
+                'encoding': {
+                    'theta': {'aggregate': 'count', 'type': 'quantitative'},
+                    'color': {'field': 'status', 'type': 'nominal'}
+                }
+            },
+            # 响应时间分布直方图
+            {
+                'title': 'Response Time Distribution',
+                'width': 400,
+                'height': 250,
+                'transform': [{'filter': success}],
+                'mark': 'bar',
+                'encoding': {
+                    'x': {'field': 'response_time', 'bin': {'maxbins': 50}, 'title': 'Response Time (ms)'},
+                    'y': {'aggregate': 'count', 'title': 'Frequency'}
+                }
+            },
+            # 可用性趋势图（60点滑动窗口，由数据API预先计算）
+            {
+                'title': 'Availability Trend (60-ping rolling)',
+                'width': 400,
+                'height': 250,
+                'mark': 'line',
+                'encoding': {
+                    'x': {'field': 'timestamp', 'type': 'temporal', 'title': 'Time'},
+                    'y': {'field': 'rolling_availability', 'type': 'quantitative', 'title': 'Availability (%)'}
+                }
+            }
+        ]
+    }
+    
+    chart_file = Path(f"data/processed/chart_{task_id}.json")
+    write_json(chart_file, spec)
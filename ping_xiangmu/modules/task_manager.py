@@ -1,17 +1,68 @@
 import threading
-import time
+import json
+import os
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, List, Tuple
+from utils.helpers import write_json
 from .ping_monitor import PingMonitor
 import uuid
 
 class TaskManager:
-    def __init__(self, max_concurrent_tasks=5):
+    def __init__(self, max_concurrent_tasks=5, state_file="data/tasks.json"):
         self.max_concurrent_tasks = max_concurrent_tasks
         self.active_tasks: Dict[str, PingMonitor] = {}
         self.completed_tasks: List[dict] = []
         self.task_history: Dict[str, dict] = {}
+        self.status_counts = Counter()  # 各状态任务数
+        self._events: Dict[str, threading.Event] = {}  # 任务结束事件
         self.lock = threading.Lock()
+        self.state_file = Path(state_file)
+        self._snapshot: Tuple[dict, ...] = ()  # 任务列表只读快照
+        
+        self._load_state()
+        self._publish_snapshot()
+        
+    def _load_state(self):
+        """从磁盘恢复任务记录（重启后仍可查看历史任务）"""
+        if not self.state_file.exists():
+            return
+            
+        try:
+            with open(self.state_file, 'r') as f:
+                self.task_history = json.load(f)
+        except Exception as e:
+            print(f"Error reading {self.state_file}: {e}")
+            return
+            
+        for task_info in self.task_history.values():
+            # 上次进程退出时仍在运行的任务已中断
+            if task_info.get('status') == 'running':
+                task_info['status'] = 'interrupted'
+            self.completed_tasks.append(task_info)
+            self.status_counts[task_info.get('status')] += 1
+    
+    def _save_state(self):
+        """保存任务记录到磁盘（调用方需持有锁）"""
+        tmp_file = self.state_file.with_suffix('.tmp')
+        write_json(tmp_file, self.task_history)
+        os.replace(tmp_file, self.state_file)
+    
+    def _publish_snapshot(self):
+        """发布不可变的任务列表快照（调用方需持有锁；属性整体替换是原子的，读者无需加锁）"""
+        self._snapshot = tuple(sorted(
+            (dict(task_info) for task_info in self.task_history.values()),
+            key=lambda x: x.get('start_time', ''),
+            reverse=True
+        ))
+    
+    def _set_status(self, task_id: str, status: str):
+        """更新任务状态并维护状态计数（调用方需持有锁）"""
+        task_info = self.task_history[task_id]
+        self.status_counts[task_info['status']] -= 1
+        task_info['status'] = status
+        self.status_counts[status] += 1
         
     def create_task(self, target_ip: str, duration_hours: int) -> str:
         """创建新的ping任务"""
@@ -22,7 +73,7 @@ class TaskManager:
         task_id = str(uuid.uuid4())[:8]
         
         # 创建ping监控器
-        monitor = PingMonitor(target_ip, duration_hours, task_id)
+        monitor = PingMonitor(target_ip, duration_hours, task_id, on_finish=self._on_task_finished)
         
         with self.lock:
             self.active_tasks[task_id] = monitor
@@ -36,91 +87,99 @@ class TaskManager:
                 'status': 'running',
                 'progress': 0
             }
+            self.status_counts['running'] += 1
+            self._events[task_id] = threading.Event()
+            self._save_state()
+            self._publish_snapshot()
         
-        # 启动任务
-        monitor.start()
-        
-        # 启动监控线程
-        threading.Thread(
-            target=self._monitor_task,
-            args=(task_id, monitor, duration_hours),
-            daemon=True
-        ).start()
+        # 启动任务，失败时撤销上面的登记
+        try:
+            monitor.start()
+        except Exception:
+            with self.lock:
+                self.active_tasks.pop(task_id, None)
+                task_info = self.task_history.pop(task_id)
+                self.status_counts[task_info['status']] -= 1
+                self._events.pop(task_id, None)
+                self._save_state()
+                self._publish_snapshot()
+            raise
         
         return task_id
     
-    def _monitor_task(self, task_id: str, monitor: PingMonitor, duration_hours: int):
-        """监控任务进度"""
-        start_time = datetime.now()
-        end_time = start_time + timedelta(hours=duration_hours)
-        
-        while monitor.is_running:
-            current_time = datetime.now()
-            
-            if current_time >= end_time:
-                monitor.stop()
-                break
-                
-            # 计算进度
-            elapsed = current_time - start_time
-            progress = min(100, (elapsed.total_seconds() / (duration_hours * 3600)) * 100)
-            
-            with self.lock:
-                if task_id in self.task_history:
-                    self.task_history[task_id]['progress'] = round(progress, 2)
-                    self.task_history[task_id]['elapsed'] = str(elapsed).split('.')[0]
-            
-            time.sleep(5)  # 每5秒更新一次进度
-        
-        # 任务完成
+    def _on_task_finished(self, task_id: str):
+        """ping监控到期结束时的回调（在ping事件循环线程中执行）"""
         with self.lock:
-            if task_id in self.active_tasks:
-                monitor = self.active_tasks.pop(task_id)
+            # 已被stop_task移除的任务不再标记为完成
+            if self.active_tasks.pop(task_id, None) is None:
+                return
                 
-            if task_id in self.task_history:
-                self.task_history[task_id]['status'] = 'completed'
-                self.task_history[task_id]['end_time'] = datetime.now().isoformat()
-                self.task_history[task_id]['progress'] = 100
-                
-                self.completed_tasks.append(self.task_history[task_id])
+            self._set_status(task_id, 'completed')
+            self.task_history[task_id]['end_time'] = datetime.now().isoformat()
+            self.task_history[task_id]['progress'] = 100
+            
+            self.completed_tasks.append(self.task_history[task_id])
+            self._save_state()
+            self._publish_snapshot()
+            self._events.pop(task_id).set()
     
     def stop_task(self, task_id: str):
         """停止任务"""
         with self.lock:
-            if task_id in self.active_tasks:
-                monitor = self.active_tasks[task_id]
-                monitor.stop()
-                
-                self.task_history[task_id]['status'] = 'stopped'
-                self.task_history[task_id]['end_time'] = datetime.now().isoformat()
+            monitor = self.active_tasks.pop(task_id, None)
+            if monitor is None:
+                return False
                 
-                self.active_tasks.pop(task_id, None)
-                return True
-        return False
+        # 在锁外等待监控器保存剩余数据，之后才标记为已停止并通知等待方
+        monitor.stop()
+        
+        with self.lock:
+            self.task_history[task_id].update(self._with_progress(self.task_history[task_id]))
+            self._set_status(task_id, 'stopped')
+            self.task_history[task_id]['end_time'] = datetime.now().isoformat()
+            
+            self._save_state()
+            self._publish_snapshot()
+            self._events.pop(task_id).set()
+            
+        return True
+    
+    @staticmethod
+    def _with_progress(task_info: dict) -> dict:
+        """按开始时间即时计算运行中任务的进度"""
+        if task_info.get('status') != 'running':
+            return task_info
+            
+        elapsed = datetime.now() - datetime.fromisoformat(task_info['start_time'])
+        progress = min(100, elapsed.total_seconds() / (task_info['duration_hours'] * 36))
+        return {
+            **task_info,
+            'progress': round(progress, 2),
+            'elapsed': str(elapsed).split('.')[0]
+        }
     
     def get_task_status(self, task_id: str) -> dict:
         """获取任务状态"""
         with self.lock:
-            return self.task_history.get(task_id, {})
+            task_info = self.task_history.get(task_id)
+            return self._with_progress(dict(task_info)) if task_info else {}
+    
+    def wait_for_task(self, task_id: str, timeout: float) -> bool:
+        """等待任务结束（完成或停止时立即返回True，超时返回False）
+
+        任务结束后事件即被移除，此后直接返回True
+        """
+        event = self._events.get(task_id)
+        return event.wait(timeout) if event else True
     
-    def get_all_tasks(self) -> List[dict]:
-        """获取所有任务"""
+    def get_task_counts(self) -> Dict[str, int]:
+        """获取各状态任务数（内存计数，无磁盘访问）"""
         with self.lock:
-            all_tasks = []
-            
-            # 活跃任务
-            for task_id, monitor in self.active_tasks.items():
-                if task_id in self.task_history:
-                    all_tasks.append(self.task_history[task_id])
-            
-            # 已完成任务
-            all_tasks.extend(self.completed_tasks)
-            
-            return sorted(
-                all_tasks, 
-                key=lambda x: x.get('start_time', ''), 
-                reverse=True
-            )
+            return {status: count for status, count in self.status_counts.items() if count}
+    
+    def get_all_tasks(self) -> Tuple[dict, ...]:
+        """获取所有任务（读取已发布的快照，不加锁）"""
+        return tuple(self._with_progress(task_info) for task_info in self._snapshot)
     
     def cleanup_old_tasks(self, days_to_keep=7):
         """清理旧任务记录"""
@@ -141,4 +200,8 @@ class TaskManager:
                         task_ids_to_remove.append(task_id)
             
             for task_id in task_ids_to_remove:
-                self.task_history.pop(task_id, None)
\ No newline at end of file
+                task_info = self.task_history.pop(task_id)
+                self.status_counts[task_info['status']] -= 1
+                
+            self._save_state()
+            self._publish_snapshot()
\ No newline at end of file
@@ -33,8 +33,10 @@ def check_dependencies():
     required_packages = [
         'flask',
         'pandas',
-        'matplotlib',
-        'ping3',
+        'pyarrow',
+        'orjson',
+        'xlsxwriter',
+        'icmplib',
         'python-dotenv',
         'APScheduler'
     ]
@@ -174,8 +176,10 @@ def create_requirements_file():
         requirements = """Flask==3.0.0
 Flask-CORS==4.0.0
 pandas==2.1.3
-matplotlib==3.8.2
-ping3==4.0.4
+pyarrow==14.0.1
+orjson==3.9.10
+XlsxWriter==3.1.9
+icmplib==3.0.4
 python-dotenv==1.0.0
 APScheduler==3.10.4
 Werkzeug==3.0.1"""
@@ -0,0 +1,18 @@
+import numpy as np
+import orjson
+
+def write_json(path, obj):
+    """用orjson写入JSON文件（缩进2格，直接支持numpy标量和数组）"""
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+
+def rolling_availability(status, success_code, window=60):
+    """滑动窗口可用性（%），用累加和实现O(N)计算；前window-1个点为NaN"""
+    success = (np.asarray(status) == success_code).view(np.uint8)
+    c = np.cumsum(success, dtype=np.int32)
+    
+    rolling = np.full(len(c), np.nan, dtype=np.float32)
+    if len(c) >= window:
+        rolling[window - 1] = c[window - 1] * (100.0 / window)
+        rolling[window:] = (c[window:] - c[:-window]) * (100.0 / window)
+    return rolling